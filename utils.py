@@ -1,15 +1,23 @@
 """
 This file provides utilities for handling structures made with H-EDit.
-Currently, only a quite bare-bones and low-performance class is available, HDict.
+Currently, only a quite bare-bones class is available, HDict, which indexes nodes and connections on first use.
 After saving your structure with pressing 'S' in H-Edit, you can load it here with `HDict.load_from_path`.
 In Python console, you can write help(HDict) to view the useful methods, and the README contains links to example projects.
 """
+import sys
 import typing
 from collections import UserDict, defaultdict
 from operator import itemgetter
-from itertools import chain, tee, starmap
-from functools import wraps
-import json
+from itertools import starmap
+from functools import wraps, cached_property, lru_cache
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    try:
+        from ujson import loads as json_loads
+    except ImportError:
+        from json import loads as json_loads
 
 
 class HDict(UserDict):
@@ -22,6 +30,9 @@ class HDict(UserDict):
         conn: [(Id, Id), ...]
     }
     where Id is either integer or (Id, Id).
+
+    Lookup indices are built lazily and dropped when a field is set or removed.
+    If you mutate 'data' or 'conn' in place, call `invalidate` afterwards.
     """
     def allow_in(*modes):
         def wrapper(method):
@@ -33,9 +44,76 @@ class HDict(UserDict):
             return safe_method
         return wrapper
 
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.invalidate()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.invalidate()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def invalidate(self):
+        """
+        Drops all cached indices, they get rebuilt on first use.
+        """
+        for name in ('_id_index', '_id_set', '_data_index', '_out', '_in', '_via_out', '_via_in'):
+            self.__dict__.pop(name, None)
+
+    @cached_property
+    def _id_index(self):
+        return {node['id']: node for node in self['data']}
+
+    @cached_property
+    def _id_set(self):
+        return frozenset(self._id_index)
+
+    @cached_property
+    def _data_index(self):
+        nodes = defaultdict(list)
+        for node in self['data']:
+            if 'data' in node:
+                nodes[node['data']].append(node)
+        return dict(nodes)
+
+    @cached_property
+    def _out(self):
+        adjacent = defaultdict(list)
+        for src, dst in self['conn']:
+            adjacent[src].append(dst)
+        return dict(adjacent)
+
+    @cached_property
+    def _in(self):
+        adjacent = defaultdict(list)
+        for src, dst in self['conn']:
+            adjacent[dst].append(src)
+        return dict(adjacent)
+
+    @cached_property
+    def _via_out(self):
+        tagged = defaultdict(set)
+        for via_id, e in self['conn']:
+            if isinstance(e, tuple):
+                src, dst = e
+                tagged[via_id, src].add(dst)
+        return dict(tagged)
+
+    @cached_property
+    def _via_in(self):
+        tagged = defaultdict(set)
+        for via_id, e in self['conn']:
+            if isinstance(e, tuple):
+                src, dst = e
+                tagged[via_id, dst].add(src)
+        return dict(tagged)
+
     def get_info(self, node_ids, *fields):
         """
-        Takes node ids and yields specified fields in (ordered) tuples.
+        Takes node ids and returns a list of the specified fields in (ordered) tuples.
         If no fields are specified, the node dict (reference) is provided instead.
         If only a single field, just the content of that field is provided.
 
@@ -44,17 +122,29 @@ class HDict(UserDict):
         if isinstance(node_ids, int):
             node_ids = [node_ids]
 
-        for node_id in node_ids:
-            n = next(self.find_nodes(id=node_id), None)
-            if n is None:
-                raise KeyError(f"No node with id {node_id} found.")
-            yield itemgetter(*fields)(n) if fields else n
+        index = self._id_index
+        try:
+            nodes = [index[node_id] for node_id in node_ids]
+        except KeyError as e:
+            raise KeyError(f"No node with id {e.args[0]} found.") from None
+
+        if not fields:
+            return nodes
+        return list(map(itemgetter(*fields), nodes))
 
     def find_nodes(self, fits=lambda n: True, **criteria):
         """
         Yields all nodes matching 'fits' and satisfying each of the criteria fields.
         """
-        for node in self['data']:
+        if 'id' in criteria:
+            node = self._id_index.get(criteria['id'])
+            candidates = () if node is None else (node,)
+        elif 'data' in criteria:
+            candidates = self._data_index.get(criteria['data'], ())
+        else:
+            candidates = self['data']
+
+        for node in candidates:
             if fits(node) and all(name in node and node[name] == value
                                   for name, value in criteria.items()):
                 yield node
@@ -66,8 +156,12 @@ class HDict(UserDict):
 
         Raises KeyError if no matches are found and ValueError if more than one match is found.
         """
-        considered = lambda n: (allowed is None or n['id'] in allowed) and n['id'] not in disallowed
-        result_it = map(itemgetter('id'), self.find_nodes(considered, data=data))
+        nodes = self._data_index.get(data, ())
+        if len(nodes) > 1:
+            allowed = None if allowed is None else set(allowed)
+            disallowed = set(disallowed)
+        result_it = (n['id'] for n in nodes
+                     if (allowed is None or n['id'] in allowed) and n['id'] not in disallowed)
 
         result = next(result_it, None)
         if result is None:
@@ -86,21 +180,19 @@ class HDict(UserDict):
         The returned items can be filtered to to contain 'nodes', 'edges', or 'both'.
         """
         if direction == 'either':
-            yield from self.connected(item_id, *via_ids, returns=returns, direction='incoming')
-            yield from self.connected(item_id, *via_ids, returns=returns, direction='outgoing')
-            return
-
-        for e in self['conn']:
-            src, dst = e if direction == 'outgoing' else reversed(e)
-
-            if src != item_id:
-                continue
-            to_node = isinstance(dst, int)
-            if (returns == 'edges' and to_node) or (returns == 'nodes' and not to_node):
-                continue
-            if all(any(e == e_ for e_ in self.connected(via_id, direction='outgoing'))
-                   for via_id in via_ids):
-                yield dst
+            sides = [(self._in, self._via_in), (self._out, self._via_out)]
+        else:
+            sides = [(self._out, self._via_out) if direction == 'outgoing' else (self._in, self._via_in)]
+
+        to_nodes, to_edges = returns != 'edges', returns != 'nodes'
+        for adjacent, tagged in sides:
+            via_others = [tagged.get((via_id, item_id), ()) for via_id in via_ids]
+            for other in adjacent.get(item_id, ()):
+                if not (to_nodes if isinstance(other, int) else to_edges):
+                    continue
+                if via_others and not all(other in others for others in via_others):
+                    continue
+                yield other
 
     def as_adjacency(self, omit_empty=True, direction='outgoing'):
         """
@@ -108,12 +200,22 @@ class HDict(UserDict):
         What should be considered adjacency can be controlled with 'direction'.
         If 'omit_empty' is true, items with no adjacent items are not included.
         """
+        if direction == 'either':
+            adjacent = {i: [*self._in.get(i, ()), *self._out.get(i, ())]
+                        for i in self._in.keys() | self._out.keys()}
+        else:
+            adjacent = self._out if direction == 'outgoing' else self._in
+
         adjacency = {}
-        for i in chain(map(itemgetter('id'), self['data']), self['conn']):
-            nbs = list(self.connected(i, direction=direction))
-            if omit_empty and not nbs:
-                continue
-            adjacency[i] = nbs
+        for node in self['data']:
+            i = node['id']
+            nbs = adjacent.get(i, ())
+            if nbs or not omit_empty:
+                adjacency[i] = list(nbs)
+        for e in self['conn']:
+            nbs = adjacent.get(e, ())
+            if nbs or not omit_empty:
+                adjacency[e] = list(nbs)
         return adjacency
 
     @allow_in('T', 'property_graph', 'edge_colored_graph', 'graph')
@@ -130,8 +232,9 @@ class HDict(UserDict):
                 return False
             return enclosing[start_i:] == e
         """
-        return [tuple(edge_ids(e)) for e in self['conn']
-                if not remove_subsumed or next(self.connected(e, direction='incoming'), None) is None]
+        if not remove_subsumed:
+            return list(map(tedge_to_tuple, self['conn']))
+        return [tedge_to_tuple(e) for e in self['conn'] if e not in self._in]
 
     @allow_in('property_graph', 'edge_colored_graph')
     def node_types(self):
@@ -144,20 +247,24 @@ class HDict(UserDict):
         3. be connected to the same number of 1. nodes as the other nodes in 3. (not enforced)
         Nodes that are not connected to other items are ignored.
         """
-        match_zero = lambda **way: lambda node: next(self.connected(node['id'], **way), None) is None
-        id_set = lambda it: set(map(itemgetter('id'), it))
-
-        no_incoming = id_set(self.find_nodes(match_zero(direction='incoming')))
-        no_outgoing = id_set(self.find_nodes(match_zero(direction='outgoing')))
-        only_to_nodes = id_set(self.find_nodes(match_zero(returns='edges', direction='outgoing')))
-        only_to_edges = id_set(self.find_nodes(match_zero(returns='nodes', direction='outgoing')))
-        disconnected_nodes = id_set(self.find_nodes(match_zero(returns='both', direction='either')))
-
-        type_1 = ((no_incoming | no_outgoing) & only_to_nodes) - disconnected_nodes
-        type_2 = (no_incoming & only_to_edges) - disconnected_nodes
-        type_3 = id_set(self['data']) - type_1 - type_2 - disconnected_nodes
-
-        assert type_1 & type_2 == type_2 & type_3 == type_3 & type_1 == set()
+        sources, sinks, to_nodes, to_edges = set(), set(), set(), set()
+        for src, dst in self['conn']:
+            sources.add(src)
+            sinks.add(dst)
+            (to_nodes if isinstance(dst, int) else to_edges).add(src)
+
+        ids = self._id_set
+        no_incoming = ids - sinks
+        no_outgoing = ids - sources
+        only_to_nodes = ids - to_edges
+        only_to_edges = ids - to_nodes
+        disconnected_nodes = no_incoming & no_outgoing
+
+        type_1 = set((no_incoming | no_outgoing) & only_to_nodes) - disconnected_nodes
+        type_2 = set(no_incoming & only_to_edges) - disconnected_nodes
+        type_3 = set(ids).difference(type_1, type_2, disconnected_nodes)
+
+        assert type_1.isdisjoint(type_2) and type_2.isdisjoint(type_3) and type_3.isdisjoint(type_1)
         return type_1, type_2, type_3
 
     @allow_in('property_graph', 'edge_colored_graph')
@@ -179,7 +286,8 @@ class HDict(UserDict):
             base_type = name if between_items else "str"
             field_type = base_type if sole else f"List[{base_type}]"
             fs.append((data, field_type, field(init=False)))
-        return make_dataclass(name, fs)
+        slots = {'slots': True} if sys.version_info >= (3, 10) else {}
+        return make_dataclass(name, fs, **slots)
 
     @allow_in('property_graph', 'edge_colored_graph')
     def as_objects(self, type_1, type_2, type_3, cls):
@@ -191,11 +299,12 @@ class HDict(UserDict):
 
         for d, T in typing.get_type_hints(cls, vars(typing), {cls.__name__: cls}).items():
             if d not in prop_id: continue
-            for i, o in id_object.items():
-                ids = self.connected(o.id, prop_id[d], direction='outgoing')
-                ins = map(id_object.__getitem__, ids) if collection_of(T, cls) else self.get_info(ids, 'data')
-                prs = list(ins) if proper_collection(T) else next(ins)
-                setattr(o, d, prs)
+            via_id, to_objects, many = prop_id[d], collection_of(T, cls), proper_collection(T)
+            for o in id_object.values():
+                tagged = self._via_out.get((via_id, o.id), ())
+                ids = [dst for dst in self._out.get(o.id, ()) if dst in tagged]
+                ins = list(map(id_object.__getitem__, ids)) if to_objects else self.get_info(ids, 'data')
+                setattr(o, d, ins if many else ins[0])
         return list(id_object.values())
 
     @classmethod
@@ -206,12 +315,12 @@ class HDict(UserDict):
         2. contains the necessary 'data' and 'conn' fields
         3. complies to the restrictions implied by mode
 
-        Raises file errors or JSONDecodeError for 1. ValueError for 2. and prints a warning for 3.
+        Raises file errors or JSONDecodeError (a ValueError) for 1. ValueError for 2. and prints a warning for 3.
         """
         modes = ['H', 'T', 'property_graph', 'edge_colored_graph', 'graph']
 
-        with open(path) as f:
-            dct = json.load(f)
+        with open(path, 'rb') as f:
+            dct = json_loads(f.read())
 
         if not ('data' in dct and 'conn' in dct):
             raise ValueError("HEdit json at least contains 'data' and 'conn' fields.")
@@ -222,10 +331,12 @@ class HDict(UserDict):
         if 'mode' in dct and not modes.index(mode) <= modes.index(dct['mode']):
             print(f"Required mode {mode!r} is stricter than found mode {dct['mode']!r}.")
 
-        dct['conn'] = list(map(convert, dct['conn']))
+        dct['conn'] = [(s, d) if isinstance(s, int) and isinstance(d, int) else (convert(s), convert(d))
+                       for s, d in dct['conn']]
         return cls(dct)
 
 
+@lru_cache
 def proper_collection(C):
     """
     Checks if type `C` is a collection (not including `str`).
@@ -234,6 +345,7 @@ def proper_collection(C):
     return issubclass(C, typing.Collection) and not issubclass(C, str)
 
 
+@lru_cache
 def collection_of(C, T):
     """
     Checks if type `C` is a collection (not including `str`) containing type `T`.
@@ -245,10 +357,10 @@ def collection_of(C, T):
 
 def convert(maybe_container, to_type=tuple):
     """
-    Convert some container recursively to some other container `to_type`.
+    Convert nested lists and tuples, as found in JSON, recursively to some other container `to_type`.
     """
-    if proper_collection(type(maybe_container)):
-        return to_type(convert(t, to_type) for t in maybe_container)
+    if isinstance(maybe_container, (list, tuple)):
+        return to_type([convert(t, to_type) for t in maybe_container])
     return maybe_container
 
 
@@ -259,15 +371,27 @@ def edge_ids(e, flatten='outgoing'):
     """
     s, d = e
     if flatten in ('incoming', 'both') and isinstance(s, tuple):
-        yield from edge_ids(s)
+        yield from tedge_to_tuple(s)
     else:
         yield s
     if flatten in ('outgoing', 'both') and isinstance(d, tuple):
-        yield from edge_ids(d)
+        yield from tedge_to_tuple(d)
     else:
         yield d
 
 
+def tedge_to_tuple(e):
+    """
+    Returns the id's of a right-nested T-edge as a flat tuple, same as `tuple(edge_ids(e))`.
+    """
+    ids = []
+    while isinstance(e, tuple):
+        s, e = e
+        ids.append(s)
+    ids.append(e)
+    return tuple(ids)
+
+
 def maybe_self_loop(it):
     """
     If there's a pair (a, a) in `it`, returns a, else returns None.
@@ -283,12 +407,20 @@ def maybe_duplicate(it, direction='incoming'):
     Returns the a duplicate value in the source or sink position, if it exists.
     """
     if direction == 'either':
-        it_in, it_out = tee(it)
-        return maybe_duplicate(it_in, 'incoming') or maybe_duplicate(it_out, 'outgoing')
-
-    ss_it = map(itemgetter(0 if direction == 'incoming' else 1), it)
+        sources, sinks = set(), set()
+        for s, d in it:
+            if s in sources:
+                return s
+            if d in sinks:
+                return d
+            sources.add(s)
+            sinks.add(d)
+        return None
+
+    i = 0 if direction == 'incoming' else 1
     extrema = set()
-    for e in ss_it:
+    for pair in it:
+        e = pair[i]
         if e in extrema:
             return e
         extrema.add(e)
@@ -299,14 +431,25 @@ def maybe_single(it, direction='incoming'):
     """
     Returns the value of the sole source or sink, if it exists.
     """
-    if direction == 'either':
-        it_in, it_out = tee(it)
-        return maybe_single(it_in, 'incoming') or maybe_single(it_out, 'outgoing')
+    it = iter(it)
+    first = next(it, None)
+    if first is None:
+        return None
 
-    ss_it = map(itemgetter(0 if direction == 'incoming' else 1), it)
-    value = next(ss_it, None)
-    for e in ss_it:
-        if e != value:
+    if direction == 'either':
+        source, sink = first
+        single_source = single_sink = True
+        for s, d in it:
+            single_source = single_source and s == source
+            single_sink = single_sink and d == sink
+            if not (single_source or single_sink):
+                return None
+        return source if single_source else sink
+
+    i = 0 if direction == 'incoming' else 1
+    value = first[i]
+    for pair in it:
+        if pair[i] != value:
             return None
     return value
 
@@ -315,15 +458,30 @@ def maybe_cycle_elem(it):
     """
     Returns pair that completes a cycle, if there are cycles.
     """
-    reachable = defaultdict(set)
-
+    adjacent = defaultdict(list)
     for s, d in it:
-        reachable[s].add(d)
-
-        for a, bs in list(reachable.items()):
-            if s in bs:
-                if a == d or a in reachable[d]:
+        if s == d:
+            return s, d
+        adjacent[s].append(d)
+
+    on_path, finished = set(), set()
+    for root in adjacent:
+        if root in finished:
+            continue
+        on_path.add(root)
+        stack = [(root, iter(adjacent[root]))]
+        while stack:
+            s, ds = stack[-1]
+            for d in ds:
+                if d in on_path:
                     return s, d
-                bs.add(d)
-                bs.update(reachable[d])
+                if d in finished or d not in adjacent:
+                    continue
+                on_path.add(d)
+                stack.append((d, iter(adjacent[d])))
+                break
+            else:
+                stack.pop()
+                on_path.remove(s)
+                finished.add(s)
     return None